@@ -12,6 +12,10 @@
 # This script can be run on the command-line standalone or ideally put into packer
 # and run via cloudwatch scheduled events like once a day or so
 #
+# By default every region is scanned, to only scan the regions you use Packer in
+# set AWS_REGIONS to a comma-separated list (eg: AWS_REGIONS=us-east-1,eu-west-1),
+# pass -r/--regions on the command-line, or send {"regions": [...]} in the event
+#
 # This is from Farley's AWS missing tools
 #    https://github.com/DevOps-Nirvana/aws-missing-tools/
 #
@@ -57,12 +61,22 @@ from __future__ import print_function
 
 # For AWS
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 # For pretty-print
 from pprint import pprint
-from datetime import datetime
-import calendar
+# For working out how long ago instances were launched
+import time
 # For checking runtime context
 import os
+# For debug output
+import logging
+# For CLI Parsing of args
+from optparse import OptionParser
+# For scanning regions in parallel
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
 
 # The maximum age (in seconds) of a packer instance before we terminate it
 # 86400 == 1 day
@@ -71,241 +85,249 @@ import os
 #  3600 == 1 hour
 max_age = 21600
 
-# Whether or not to output debug info as it does things
-debug = False
-
-# Our AWS regions, we'll call the AWS API to get the list of regions, so this is always up to date
-ec2 = boto3.client('ec2', region_name='us-west-1')
-regions = []
-awsregions = ec2.describe_regions()['Regions']
-for region in awsregions:
-    regions.append(region['RegionName'])
-del ec2, awsregions
-
-# Helper to convert datetime with TZ to Unix time
-def dt2ts(dt):
-    return calendar.timegm(dt.utctimetuple())
+# Whether or not to output debug info as it does things, set LOG_LEVEL=DEBUG to enable it
+# NOTE: All our output goes through logging (not print) as its handlers lock, so lines from worker threads don't interleave
+# NOTE: Only our own logger gets LOG_LEVEL, the root logger stays at its default so botocore stays quiet
+logging.basicConfig(format='%(message)s')
+logger = logging.getLogger(__name__)
+try:
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+except ValueError:
+    logger.setLevel(logging.INFO)
+    logger.warning("Invalid LOG_LEVEL %r, falling back to INFO", os.environ['LOG_LEVEL'])
+
+# Every call we make is network bound, so we scan and cleanup every resource type in every region in parallel
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Our clients are shared between worker threads, so give them enough connections to go around
+# and let botocore rate limit and back off on throttling instead of us dropping deletions
+CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={
+        'mode': 'adaptive',
+        'max_attempts': 10,
+    }
+)
+
+# The EC2 filters matching packer instances, the API does the tag matching for us so we never look at tags ourselves
+PACKER_INSTANCE_FILTERS = [
+    {
+        'Name': 'instance-state-name',
+        'Values': ['running'],
+    },
+    {
+        'Name': 'tag:Name',
+        'Values': ['Packer Builder'],
+    },
+]
+
+# The maximum number of instance ids AWS accepts in a single terminate_instances call
+TERMINATE_BATCH_SIZE = 1000
+
+# The one boto3 session all our clients are built from, so the EC2 service model is only loaded once
+_SESSION = boto3.session.Session()
+
+# Helper to get an EC2 client for a region, building a client is slow so we only do it once per region
+# NOTE: Sessions are not thread-safe, so only call this from the main thread and hand the (thread-safe)
+#       clients to the worker threads
+@lru_cache(maxsize=None)
+def ec2_client(region):
+    return _SESSION.client('ec2', region_name=region, config=CLIENT_CONFIG)
+
+# Helper to turn a comma-separated list of regions into a list
+def parse_regions(value):
+    return [region.strip() for region in value.split(',') if region.strip()]
+
+# Our AWS regions, unless given in AWS_REGIONS we'll call the AWS API to get the list of regions, so this is always up to date
+# NOTE: This is looked up on first use and cached, so it stays off Lambda cold starts and only happens once per container
+_regions_cache = None
+def get_regions():
+    global _regions_cache
+    if _regions_cache is None:
+        if os.environ.get('AWS_REGIONS'):
+            _regions_cache = parse_regions(os.environ['AWS_REGIONS'])
+        else:
+            _regions_cache = [region['RegionName'] for region in ec2_client('us-west-1').describe_regions()['Regions']]
+    return _regions_cache
+
+# The intervals display_time breaks seconds down into, largest first
+_DISPLAY_INTERVALS = (
+    ('months', 18144000), # 60 * 60 * 24 * 7 * 30 (roughly)
+    ('weeks', 604800),    # 60 * 60 * 24 * 7
+    ('days', 86400),      # 60 * 60 * 24
+    ('hours', 3600),      # 60 * 60
+    ('minutes', 60),
+    ('seconds', 1),
+)
 
 # Helper to convert seconds to a sexy format "x hours, x minutes, x seconds" etc
 def display_time(seconds, granularity=2):
-    intervals = (
-        ('months', 18144000), # 60 * 60 * 24 * 7 * 30 (roughly)
-        ('weeks', 604800),    # 60 * 60 * 24 * 7
-        ('days', 86400),      # 60 * 60 * 24
-        ('hours', 3600),      # 60 * 60
-        ('minutes', 60),
-        ('seconds', 1),
-        )
-
     result = []
 
-    for name, count in intervals:
-        value = seconds // count
+    for name, count in _DISPLAY_INTERVALS:
+        value, seconds = divmod(seconds, count)
         if value:
-            seconds -= value * count
-            if value == 1:
-                name = name.rstrip('s')
-            result.append("{} {}".format(value, name))
-    return ', '.join(result[:granularity])
-
-# Get instances from AWS from all regions that...
-#    #1: Are currently running
-#    #2: Have the name "Packer Builder"
+            result.append(f"{value} {name[:-1] if value == 1 else name}")
+            if len(result) == granularity:
+                break
+    return ', '.join(result)
+
+# Helper to split an iterable into lists of (at most) size items
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+# Yields the ids of instances from AWS in a region that...
+#    #1: Are currently running                           (filtered by AWS)
+#    #2: Have the name "Packer Builder"                  (filtered by AWS)
 #    #3: Have been alive longer than our specified limit
-def get_zombie_packer_instances(regions, maximum_age):
-    global debug
-    output = {}
+def iter_zombie_instances(region, ec2, maximum_age):
+    logger.debug("Scanning region %s for instances", region)
 
     # Get our "now" timestamp for knowing how long ago instances were launched
-    utc_now = datetime.now()
-    utc_now_ts  = int(utc_now.strftime("%s"))
-
-    for region in regions:
-        regionoutput = []
-        if debug is True:
-            print(f"Scanning region {region} for instances")
-
-        # Create our EC2 Handler
-        ec2 = boto3.client('ec2', region_name=region)
-
-        response = ec2.describe_instances(
-            MaxResults=1000
-        )
-
-        for reservation in response['Reservations']:
+    utc_now_ts = time.time()
+
+    # Let AWS do the filtering for us, EC2 can't filter on launch time though so we do that below
+    paginator = ec2.get_paginator('describe_instances')
+    pages = paginator.paginate(
+        Filters=PACKER_INSTANCE_FILTERS,
+        PaginationConfig={
+            'PageSize': 1000,
+        }
+    )
+
+    for page in pages:
+        for reservation in page['Reservations']:
             for instance in reservation['Instances']:
 
-                if debug is True:
-                    print(f"Found instance: {instance['InstanceId']}")
-                if instance['State']['Name'] == "running":
-                    if debug is True:
-                        print("  Instance is currently running")
-                else:
-                    if debug is True:
-                        print("  Instance is not currently running, skipping...")
-                    continue
-
-                packerNameTagMatched = False
-                if 'Tags' in instance:
-                    for tag in instance['Tags']:
-                        if tag['Key'] == 'Name' and tag['Value'] == 'Packer Builder':
-                            if debug is True:
-                                print("  Instance is a packer builder")
-                            packerNameTagMatched = True
-                            break
-                        elif tag['Key'] == 'Name':
-                            if debug is True:
-                                print("  Instance is NOT a packer building, skipping...")
-                            break
-
-                if packerNameTagMatched is False:
-                    continue
-
-                if debug is True:
-                    print(f"    Found packer instance: {instance['InstanceId']}")
-                launched_at = dt2ts(instance['LaunchTime'])
-                if debug is True:
-                    print(f"    Instance started {display_time(utc_now_ts - launched_at)} ago ")
+                logger.debug("    Found packer instance: %s", instance['InstanceId'])
+                launched_at = instance['LaunchTime'].timestamp()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("    Instance started %s ago ", display_time(int(utc_now_ts - launched_at)))
                 # if (utc_now_ts - launched_at) > 86400:
                 if (utc_now_ts - launched_at) > maximum_age:
-                    if debug is True:
-                        print("    Instance started more than a day ago, should be marked for termination")
-                    regionoutput.append({
-                        "region": region,
-                        "instance_id": instance['InstanceId'],
-                        "keyname": instance['KeyName'],
-                        "security_groups": instance['SecurityGroups']
-                    })
+                    logger.debug("    Instance started more than a day ago, should be marked for termination")
+                    yield instance['InstanceId']
                 else:
-                    if debug is True:
-                        print("    Instance is too new to be terminated")
+                    logger.debug("    Instance is too new to be terminated")
 
-        output[region] = regionoutput
-    return output
+def get_zombie_packer_keys(region, ec2):
+    output = []
+    logger.debug("Scanning region %s for keys", region)
 
-def get_zombie_packer_keys(regions):
-    global debug
-    output = {}
-    for region in regions:
-        regionoutput = []
-        if debug is True:
-            print("Scanning region {region} for keys")
-
-        # Create our EC2 Handler
-        ec2 = boto3.client('ec2', region_name=region)
-
-        response = ec2.describe_key_pairs(
-            Filters=[
-                {
-                    'Name': 'key-name',
-                    'Values': ['packer *'],
-                },
-            ]
-        )
+    response = ec2.describe_key_pairs(
+        Filters=[
+            {
+                'Name': 'key-name',
+                'Values': ['packer *'],
+            },
+        ]
+    )
 
-        for pair in response['KeyPairs']:
-            regionoutput.append(pair['KeyName'])
+    for pair in response['KeyPairs']:
+        output.append(pair['KeyName'])
 
-        output[region] = regionoutput
     return output
 
 
-def get_zombie_packer_security_groups(regions):
-    global debug
-    output = {}
-    for region in regions:
-        regionoutput = []
-        if debug is True:
-            print(f"Scanning region {region} for security groups")
-
-        # Create our EC2 Handler
-        ec2 = boto3.client('ec2', region_name=region)
-
-        response = ec2.describe_security_groups(
-            Filters=[
-                {
-                    'Name': 'group-name',
-                    'Values': ['packer_*'],
-                },
-            ]
-        )
+def get_zombie_packer_security_groups(region, ec2):
+    output = []
+    logger.debug("Scanning region %s for security groups", region)
 
-        # NOTE:
-        # Checking for stales doesn't seem to work, so we'll just try to delete without checking stale
-        for pair in response['SecurityGroups']:
-            regionoutput.append(pair['GroupName'])
+    response = ec2.describe_security_groups(
+        Filters=[
+            {
+                'Name': 'group-name',
+                'Values': ['packer_*'],
+            },
+        ]
+    )
 
-        output[region] = regionoutput
-    return output
-
-def lambda_handler(event, context):
-    global regions, max_age
-
-    print(f"Scanning {len(regions)} AWS regions for zombie packer instances...")
+    # NOTE:
+    # Checking for stales doesn't seem to work, so we'll just try to delete without checking stale
+    for pair in response['SecurityGroups']:
+        output.append(pair['GroupName'])
 
-    zombies = get_zombie_packer_instances(regions, max_age)
-    for region,instances in zombies.items():
-        if len(instances) == 0:
-            print("Found NO zombie instances in {region}, skipping...")
-            continue
+    return output
 
-        print(f"Found {len(instances)} zombie packer instances in {region}, now terminating...")
-        ec2 = boto3.client('ec2', region_name=region)
+# NOTE: Only ClientErrors (eg: resource still in use) are logged and skipped, throttling is retried by
+#       botocore and anything unexpected is raised so Lambda's own retry policy picks it up
+def terminate_instances(ec2, instance_ids):
+    try:
+        ec2.terminate_instances(
+            InstanceIds=instance_ids
+        )
+        logger.info("Successfully terminated %s instances", len(instance_ids))
+    except ClientError as e:
+        logger.error("Unable to terminate some or all resources: %s", e)
+
+def delete_key_pair(ec2, keyname):
+    try:
+        logger.info("Deleting key %s", keyname)
+        ec2.delete_key_pair(
+            KeyName=keyname
+        )
+        logger.info("Deleted key %s", keyname)
+    except ClientError as e:
+        logger.error("Error while trying to delete key %s: %s", keyname, e)
+
+def delete_security_group(ec2, security_group):
+    try:
+        logger.info("Deleting security group %s", security_group)
+        ec2.delete_security_group(
+            GroupName=security_group
+        )
+        logger.info("Deleted security group %s", security_group)
+    except ClientError as e:
+        logger.error("Error while trying to delete security group %s: %s", security_group, e)
 
-        instance_ids = []
-        for instance in instances:
-            instance_ids.append(instance['instance_id'])
+def lambda_handler(event, context):
+    global max_age
 
-        try:
-            response = ec2.terminate_instances(
-                InstanceIds=instance_ids
-            )
-            print("Successfully terminated instances")
-        except:
-            print("ERROR: Unable to terminate some or all resources")
+    # Allow the event to override which regions we scan, as a list or a comma-separated string
+    regions = event.get('regions') or get_regions()
+    if isinstance(regions, str):
+        regions = parse_regions(regions)
 
-    print(f"Scanning {len(regions)} AWS regions for zombie packer keys...")
+    logger.info("Scanning %s AWS regions for zombie packer instances, keys and security groups...", len(regions))
 
-    zombies = get_zombie_packer_keys(regions)
-    for region,keynames in zombies.items():
-        if len(keynames) == 0:
-            print(f"Found NO zombie keys in {region}, skipping...")
+    # Kick off every scan in every region at once...
+    # NOTE: The instance scan is a generator, so it only actually runs once list() consumes it on a worker
+    scans = {}
+    for region in regions:
+        ec2 = ec2_client(region)
+        scans[EXECUTOR.submit(list, iter_zombie_instances(region, ec2, max_age))] = (region, 'instances')
+        scans[EXECUTOR.submit(get_zombie_packer_keys, region, ec2)] = (region, 'keys')
+        scans[EXECUTOR.submit(get_zombie_packer_security_groups, region, ec2)] = (region, 'security groups')
+
+    # ...and start deleting what each one found as soon as it comes back
+    deletions = []
+    for scan in as_completed(scans):
+        region, resource = scans[scan]
+        zombies = scan.result()
+        if len(zombies) == 0:
+            logger.info("Found NO zombie %s in %s, skipping...", resource, region)
             continue
 
-        print(f"Found {len(keynames)} zombie packer keys in {region}, now deleting...")
-        ec2 = boto3.client('ec2', region_name=region)
-
-        for keyname in keynames:
-            try:
-                print("Deleting key " + keyname)
-                response = ec2.delete_key_pair(
-                    KeyName=keyname
-                )
-                print("Deleted")
-            except:
-                print("Error while trying to terminate resources")
-
-
-    print(f"Scanning {len(regions)} AWS regions for zombie packer security groups...")
-
-    zombies = get_zombie_packer_security_groups(regions)
-    for region,security_groups in zombies.items():
-        if len(security_groups) == 0:
-            print("Found NO zombie security groups in " + region + ", skipping...")
-            continue
+        logger.info("Found %s zombie packer %s in %s, now deleting...", len(zombies), resource, region)
+        ec2 = ec2_client(region)
 
-        print(f"Found {len(security_groups)} zombie security groups in {region}, now terminating...")
-        ec2 = boto3.client('ec2', region_name=region)
+        if resource == 'instances':
+            for chunk in chunks(zombies, TERMINATE_BATCH_SIZE):
+                deletions.append(EXECUTOR.submit(terminate_instances, ec2, chunk))
+        elif resource == 'keys':
+            for keyname in zombies:
+                deletions.append(EXECUTOR.submit(delete_key_pair, ec2, keyname))
+        else:
+            for security_group in zombies:
+                deletions.append(EXECUTOR.submit(delete_security_group, ec2, security_group))
 
-        for security_group in security_groups:
-            try:
-                print(f"Deleting security group {security_group}")
-                response = ec2.delete_security_group(
-                    GroupName=security_group
-                )
-                print("Deleted")
-            except:
-                print("Error while trying to terminate resources")
+    # Wait for all our deletions, this re-raises anything unexpected
+    for deletion in as_completed(deletions):
+        deletion.result()
 
 # References:
 # https://unbiased-coder.com/detect-aws-env-python-nodejs/
@@ -314,4 +336,14 @@ def is_aws_env():
     return os.environ.get('AWS_LAMBDA_FUNCTION_NAME') or os.environ.get('AWS_EXECUTION_ENV')
 
 if not is_aws_env():
-    lambda_handler({}, {})
+    parser = OptionParser(usage="usage: %prog [-r regions]")
+    parser.add_option("-r", "--regions",
+                      dest="regions",
+                      default="",
+                      help="Comma-separated list of regions to scan (defaults to AWS_REGIONS, or all regions)",
+                      metavar="regions")
+    (options, args) = parser.parse_args()
+    event = {}
+    if options.regions:
+        event['regions'] = options.regions
+    lambda_handler(event, {})